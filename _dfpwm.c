@@ -0,0 +1,122 @@
+/*
+ * Native DFPWM predictor loop for encode_song.py.
+ *
+ * Build with: python setup.py build_ext --inplace
+ *
+ * encode(samples, state, bits)
+ *   samples: int8 buffer of PCM samples (-128..127)
+ *   state:   writable int64 buffer [charge, strength, previous_bit],
+ *            read on entry and written back on exit so calls can be chained
+ *   bits:    writable uint8 buffer, receives one decided bit (0/1) per sample
+ *
+ * The loop runs with the GIL released so several songs can be encoded
+ * from threads at once.
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <stdint.h>
+#include <string.h>
+
+#define CLAMP(v, lo, hi) ((v) < (lo) ? (lo) : ((v) > (hi) ? (hi) : (v)))
+
+static void encode_core(const int8_t *samples, Py_ssize_t n, int64_t *state, uint8_t *bits)
+{
+    register int64_t charge = state[0];
+    register int64_t strength = state[1];
+    register int64_t previous_bit = state[2];
+    Py_ssize_t i;
+
+    for (i = 0; i < n; i++) {
+        /* Predict */
+        register int64_t bit = samples[i] > charge;
+
+        /* Update Strength (+1 when the bit repeats, -1 when it flips) */
+        strength += 1 - 2 * (bit ^ previous_bit);
+        strength = CLAMP(strength, 0, 63);
+
+        /* Apply change towards the predicted direction and clamp */
+        charge += ((bit << 1) - 1) * ((strength << 2) + 2);
+        charge = CLAMP(charge, -128, 127);
+
+        previous_bit = bit;
+        bits[i] = (uint8_t)bit;
+    }
+
+    state[0] = charge;
+    state[1] = strength;
+    state[2] = previous_bit;
+}
+
+/* Checks a buffer holds contiguous items of the given size whose struct
+ * format code (after any byte-order prefix) is one of the allowed ones. */
+static int check_buffer(Py_buffer *view, const char *name, Py_ssize_t itemsize, const char *codes)
+{
+    const char *fmt = view->format ? view->format : "B";
+
+    if (*fmt == '@' || *fmt == '=' || *fmt == '<')
+        fmt++;
+    if (view->itemsize != itemsize || fmt[0] == '\0' || fmt[1] != '\0' || !strchr(codes, fmt[0])) {
+        PyErr_Format(PyExc_TypeError, "%s has the wrong item type (format '%s')",
+                     name, view->format ? view->format : "B");
+        return 0;
+    }
+    return 1;
+}
+
+static PyObject *dfpwm_encode(PyObject *self, PyObject *args)
+{
+    PyObject *samples_obj, *state_obj, *bits_obj;
+    Py_buffer samples, state, bits;
+    PyObject *result = NULL;
+    (void)self;
+
+    if (!PyArg_ParseTuple(args, "OOO", &samples_obj, &state_obj, &bits_obj))
+        return NULL;
+
+    if (PyObject_GetBuffer(samples_obj, &samples, PyBUF_C_CONTIGUOUS | PyBUF_FORMAT) < 0)
+        return NULL;
+    if (PyObject_GetBuffer(state_obj, &state, PyBUF_C_CONTIGUOUS | PyBUF_FORMAT | PyBUF_WRITABLE) < 0)
+        goto release_samples;
+    if (PyObject_GetBuffer(bits_obj, &bits, PyBUF_C_CONTIGUOUS | PyBUF_FORMAT | PyBUF_WRITABLE) < 0)
+        goto release_state;
+
+    /* int8 samples, int64 state (q or l depending on platform), uint8 bits */
+    if (!check_buffer(&samples, "samples", 1, "b")
+            || !check_buffer(&state, "state", 8, "ql")
+            || !check_buffer(&bits, "bits", 1, "B"))
+        goto release_all;
+
+    if (state.len < 3 * 8 || bits.len < samples.len) {
+        PyErr_SetString(PyExc_ValueError, "state needs 3 int64 slots and bits one byte per sample");
+        goto release_all;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    encode_core((const int8_t *)samples.buf, samples.len, (int64_t *)state.buf, (uint8_t *)bits.buf);
+    Py_END_ALLOW_THREADS
+
+    Py_INCREF(Py_None);
+    result = Py_None;
+
+release_all:
+    PyBuffer_Release(&bits);
+release_state:
+    PyBuffer_Release(&state);
+release_samples:
+    PyBuffer_Release(&samples);
+    return result;
+}
+
+static PyMethodDef dfpwm_methods[] = {
+    {"encode", dfpwm_encode, METH_VARARGS, "Run the DFPWM predictor over int8 samples."},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef dfpwm_module = {
+    PyModuleDef_HEAD_INIT, "_dfpwm", NULL, -1, dfpwm_methods
+};
+
+PyMODINIT_FUNC PyInit__dfpwm(void)
+{
+    return PyModule_Create(&dfpwm_module);
+}
@@ -1,9 +1,10 @@
 import os
 import sys
 import subprocess
-import wave
-import struct
 import json
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
 
 # Try to import the existing encoder
 try:
@@ -12,88 +13,191 @@ except ImportError:
     print("Error: encode_song.py not found in current directory.")
     sys.exit(1)
 
-def convert_mp3_to_wav(mp3_path):
-    wav_path = mp3_path.rsplit('.', 1)[0] + ".temp.wav"
-    # ffmpeg -y -i input.mp3 -ac 1 -ar 48000 -sample_fmt s16 output.wav
-    # We use 48kHz as target rate
+try:
+    # PyAV decodes in-process; without it we spawn the ffmpeg binary
+    import av
+except ImportError:
+    av = None
+
+# Bytes of PCM read from ffmpeg per encode step (32k 16-bit samples)
+CHUNK_SIZE = 1 << 16
+
+def open_mp3_stream(mp3_path):
+    # ffmpeg -y -i input.mp3 -ac 1 -ar 48000 -f s16le -
+    # We use 48kHz as target rate and read raw PCM straight from stdout
+    # while ffmpeg is still decoding, so decode and encode overlap.
     cmd = [
         "ffmpeg", "-y", 
         "-i", mp3_path, 
         "-ac", "1", 
         "-ar", "48000", 
-        "-sample_fmt", "s16", 
-        wav_path
+        "-f", "s16le", 
+        "-"
     ]
     
     try:
-        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        return wav_path
+        return subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, bufsize=1 << 20)
     except FileNotFoundError:
         print("CRITICAL: ffmpeg not found.")
         print("Please install it by running: winget install Gyan.FFmpeg")
         print("After installing, you may need to restart your terminal.")
         return None
-    except subprocess.CalledProcessError:
-        print("Error: ffmpeg failed to convert the file.")
+
+def read_pcm_stream(proc):
+    # Yields 16-bit PCM chunks from a running ffmpeg process
+    with proc:
+        while chunk := proc.stdout.read(CHUNK_SIZE):
+            # We requested s16le from ffmpeg, so it should be consistent.
+            yield np.frombuffer(chunk, dtype='<i2', count=len(chunk) // 2)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+def decode_mp3_av(mp3_path):
+    # Yields 16-bit mono 48kHz PCM chunks decoded in-process with PyAV
+    with av.open(mp3_path) as container:
+        stream = container.streams.audio[0]
+        resampler = av.AudioResampler(format='s16', layout='mono', rate=48000)
+        for frame in container.decode(stream):
+            for out in resampler.resample(frame):
+                yield out.to_ndarray().reshape(-1)
+        # Drain whatever the resampler still buffers
+        for out in resampler.resample(None):
+            yield out.to_ndarray().reshape(-1)
+
+def convert_file(mp3_filename):
+    """
+    Converts one MP3 to DFPWM without touching the manifest.
+    Returns (title, dfpwm_filename) on success, None otherwise; never raises,
+    so one bad file can't take down a batch.
+    """
+    try:
+        return _convert_file(mp3_filename)
+    except Exception as e:
+        print(f"Error converting {mp3_filename}: {e}")
         return None
 
-def process_file(mp3_filename):
+def _convert_file(mp3_filename):
     if not os.path.exists(mp3_filename):
         print(f"File not found: {mp3_filename}")
-        return
+        return None
+
+    # Derive output name and a nice title once from the input path
+    stem, _ = os.path.splitext(mp3_filename)
+    dfpwm_filename = stem + ".dfpwm"
+    title = os.path.basename(stem)
+
+    # Skip the work entirely if the output is already newer than the input.
+    # This is safe because a .dfpwm only ever appears at its final path once
+    # it was fully encoded (partial output lives in a .tmp file, see below).
+    if (os.path.isfile(dfpwm_filename)
+            and os.path.getmtime(dfpwm_filename) >= os.path.getmtime(mp3_filename)):
+        print(f"Up-to-date: {dfpwm_filename}")
+        return title, dfpwm_filename
 
     print(f"Processing {mp3_filename}...")
     
-    # 1. Convert to WAV
-    wav_path = convert_mp3_to_wav(mp3_filename)
-    if not wav_path:
-        return
-        
-    # 2. Read WAV and Prepare Samples
+    # 1. Start decoding to raw PCM
+    if av is not None:
+        pcm_chunks = decode_mp3_av(mp3_filename)
+    else:
+        proc = open_mp3_stream(mp3_filename)
+        if proc is None:
+            return None
+        pcm_chunks = read_pcm_stream(proc)
+
+    print("Encoding to DFPWM...")
+    
+    # 2. Encode chunk by chunk and stream the result to a temp file, which
+    # only replaces the real output once the whole song encoded fine
+    tmp_filename = dfpwm_filename + ".tmp"
+    encoder = encode_song.DFPWMEncoder()
+    total_samples = 0
+    created = False
     try:
-        w = wave.open(wav_path, 'rb')
-        params = w.getparams()
-        frames = w.readframes(params.nframes)
-        w.close()
-        os.remove(wav_path) # Cleanup temp file
+        with open(tmp_filename, 'wb') as f:
+            created = True
+            for pcm in pcm_chunks:
+                # Convert 16-bit PCM to 8-bit signed samples
+                # Downscale to -128..127 (arithmetic shift == floor division by 256)
+                samples = np.right_shift(pcm, 8).astype(np.int8)
+                f.write(encoder.feed(samples))
+                total_samples += len(samples)
+            f.write(encoder.flush())
+        os.replace(tmp_filename, dfpwm_filename)
+    except subprocess.CalledProcessError:
+        print("Error: ffmpeg failed to convert the file.")
+        return None
     except Exception as e:
-        print(f"Error reading WAV data: {e}")
-        if os.path.exists(wav_path): os.remove(wav_path)
-        return
-
-    # Convert 16-bit PCM to 8-bit signed samples
-    # We requested s16 from ffmpeg, so it should be consistent.
-    samples = []
-    total_samples = len(frames) // 2
-    for i in range(total_samples):
-        val = struct.unpack_from('<h', frames, i*2)[0]
-        # Downscale to -128..127
-        samples.append(val // 256)
+        print(f"Error decoding {mp3_filename}: {e}")
+        return None
+    finally:
+        # Also runs on Ctrl-C: stop the decoder and drop the partial output
+        pcm_chunks.close()
+        if created and os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
         
-    print(f"Encoding {len(samples)} samples to DFPWM...")
-    
-    # 3. Encode
-    dfpwm_data = encode_song.encode_dfpwm(samples)
-    
-    # 4. Save DFPWM
-    dfpwm_filename = mp3_filename.rsplit('.', 1)[0] + ".dfpwm"
-    with open(dfpwm_filename, 'wb') as f:
-        f.write(dfpwm_data)
+    print(f"Saved: {dfpwm_filename} ({total_samples} samples)")
+    return title, dfpwm_filename
+
+def process_file(mp3_filename):
+    result = convert_file(mp3_filename)
+    if result:
+        # 3. Update Manifest
+        update_manifest(*result)
+
+def expand_targets(targets):
+    # Directories are expanded to the MP3s directly inside them
+    paths = []
+    for target in targets:
+        if os.path.isdir(target):
+            for name in sorted(os.listdir(target)):
+                if name.lower().endswith(".mp3"):
+                    paths.append(os.path.join(target, name))
+        else:
+            paths.append(target)
+    return paths
+
+def process_files(mp3_filenames):
+    """
+    Converts many MP3s in parallel and updates the manifest in a single pass.
+    With a GIL-free encoder core (C extension or Numba) threads are used, so
+    there is no per-worker start-up; otherwise worker processes (each paying
+    the import once).
+    """
+    if len(mp3_filenames) <= 1:
+        results = [convert_file(path) for path in mp3_filenames]
+    else:
+        workers = min(os.cpu_count() or 1, len(mp3_filenames))
+        executor = ThreadPoolExecutor if encode_song.NOGIL_CORE else ProcessPoolExecutor
+        with executor(max_workers=workers) as pool:
+            futures = [pool.submit(convert_file, path) for path in mp3_filenames]
         
-    print(f"Saved: {dfpwm_filename}")
-    
-    # 5. Update Manifest
-    update_manifest(mp3_filename, dfpwm_filename)
+        # Collect per file, so a crashed worker only loses its own entry
+        results = []
+        for path, future in zip(mp3_filenames, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                print(f"Error converting {path}: {e}")
+                results.append(None)
+            
+    entries = [result for result in results if result]
+    if entries:
+        update_manifest_many(entries)
+    print(f"Converted {len(entries)}/{len(mp3_filenames)} files.")
 
-def update_manifest(input_title_path, output_path):
-    manifest_path = "manifest.json"
-    
-    # Derive a nice title
-    base_name = os.path.basename(input_title_path)
-    title = base_name.rsplit('.', 1)[0]
-    
-    # Normalize path for JSON (forward slashes)
-    file_entry = output_path.replace("\\", "/")
+MANIFEST_PATH = "manifest.json"
+
+def update_manifest(title, output_path):
+    update_manifest_many([(title, output_path)])
+
+def update_manifest_many(entries):
+    """
+    Adds (title, output_path) pairs to the manifest with a single
+    read and at most one write.
+    """
+    manifest_path = MANIFEST_PATH
     
     if os.path.exists(manifest_path):
         with open(manifest_path, 'r') as f:
@@ -107,30 +211,42 @@ def update_manifest(input_title_path, output_path):
     if "songs" not in data:
         data["songs"] = []
         
-    # Check for duplicate
-    exists = False
-    for song in data["songs"]:
-        if song.get("file") == file_entry:
-            exists = True
-            break
+    existing = {song.get("file") for song in data["songs"]}
+    added = 0
+    
+    for title, output_path in entries:
+        # Normalize path for JSON (forward slashes)
+        file_entry = output_path.replace("\\", "/")
+        
+        # Check for duplicate
+        if file_entry in existing:
+            print(f"{title} already in manifest.")
+            continue
             
-    if not exists:
         data["songs"].append({
             "title": title,
             "file": file_entry
         })
+        existing.add(file_entry)
+        added += 1
         
-        with open(manifest_path, 'w') as f:
-            json.dump(data, f, indent=4)
-        print("Updated manifest.json")
-    else:
-        print("Song already in manifest.")
+    if not added:
+        return
+        
+    # Write to a temp file and swap it in, so an interrupted run
+    # can never leave a half-written manifest behind
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=4)
+    os.replace(tmp_path, manifest_path)
+    print(f"Updated {manifest_path}")
 
 if __name__ == "__main__":
+    # usage: python convert_mp3.py [file.mp3 | folder] ...
     if len(sys.argv) > 1:
-        target = sys.argv[1]
+        targets = sys.argv[1:]
     else:
         # Default for the current request
-        target = r"songs\neon_nights.mp3"
+        targets = [r"songs\neon_nights.mp3"]
         
-    process_file(target)
+    process_files(expand_targets(targets))
@@ -1,70 +1,225 @@
 import wave
 import sys
-import struct
 import base64
 import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+    # Numba is optional; without it encoding uses _encode_dfpwm_py below.
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda fn: fn
+
+try:
+    # Optional C extension, built with: python setup.py build_ext --inplace
+    import _dfpwm
+except ImportError:
+    _dfpwm = None
+
+# True when the encoder core runs without holding the GIL, so threads can
+# encode several songs at once
+NOGIL_CORE = _dfpwm is not None or HAVE_NUMBA
 
 # usage: python encode_song.py input.wav output.lua [sample_rate]
 
-def encode_dfpwm(pcm_samples):
+# Charge step for each of the 64 strength levels: (strength << 2) + 2
+# Tuning: (strength << 2) + 2 is rough but works.
+CHANGE_LUT = np.array([(s << 2) + 2 for s in range(64)], dtype=np.int16)
+# Direction of the charge step for bit 0 / bit 1
+SIGN_LUT = np.array([-1, 1], dtype=np.int16)
+
+@njit(cache=True, nogil=True)
+def _encode_dfpwm_core(samples, state, bits):
     """
-    Encodes 8-bit signed PCM samples (-128 to 127) into DFPWM.
-    This is an approximation of the standard DFPWM1a algorithm.
+    DFPWM predictor loop over a typed int8 array.
+    state is an int64 array [charge, strength, previous_bit] that is read
+    on entry and written back on exit, so calls can be chained.
+    Writes one decided bit (0/1) per sample into the preallocated uint8 bits.
     """
-    charge = 0
-    strength = 0
-    previous_bit = False
-    
-    out_bytes = bytearray()
-    current_byte = 0
-    bit_idx = 0
-    
-    for sample in pcm_samples:
+    n = samples.shape[0]
+
+    charge = state[0]
+    strength = state[1]
+    previous_bit = state[2]
+
+    for i in range(n):
         # Predict
-        bit = (sample > charge)
-        
+        bit = int(samples[i] > charge)
+
+        # Update Strength (+1 when the bit repeats, -1 when it flips)
+        strength += 1 - 2 * (bit ^ previous_bit)
+        strength = max(0, min(63, strength))
+
+        # Update Charge
+        # Uses a heuristic response curve similar to standard DFPWM
+        change = CHANGE_LUT[strength]
+
+        # Apply change towards the predicted direction and clamp
+        charge += SIGN_LUT[bit] * change
+        charge = max(-128, min(127, charge))
+
+        previous_bit = bit
+        bits[i] = bit
+
+    state[0] = charge
+    state[1] = strength
+    state[2] = previous_bit
+
+# Plain tuples for the pure-Python path: indexing NumPy arrays per sample
+# costs far more than indexing Python sequences
+_CHANGE_STEPS = tuple(CHANGE_LUT.tolist())
+_SIGNS = tuple(SIGN_LUT.tolist())
+
+def _encode_dfpwm_py(samples, state, bits):
+    """
+    Same predictor as _encode_dfpwm_core, shaped for CPython: it walks
+    Python ints from samples.tolist() and clamps with plain ifs, which the
+    interpreter runs much faster than NumPy scalars or min/max calls.
+    """
+    charge, strength, previous_bit = state.tolist()
+    change_steps = _CHANGE_STEPS
+    signs = _SIGNS
+    out = bytearray(len(samples))
+
+    for i, sample in enumerate(samples.tolist()):
+        # Predict
+        bit = 1 if sample > charge else 0
+
         # Update Strength
         if bit == previous_bit:
-            strength += 1
-        else:
+            if strength < 63: strength += 1
+        elif strength > 0:
             strength -= 1
-        
-        if strength < 0: strength = 0
-        if strength > 63: strength = 63
-        
+
         # Update Charge
-        # Uses a heuristic response curve similar to standard DFPWM
-        step = (strength << 2) + (1 if strength < 50 else 0) 
-        # Tuning: (strength << 2) + 2 is rough but works.
-        change = (strength << 2) + 2
-        
-        # Apply change
-        if bit:
-            charge += change
-        else:
-            charge -= change
-            
-        # Clamp charge
+        charge += signs[bit] * change_steps[strength]
         if charge > 127: charge = 127
-        if charge < -128: charge = -128
-        
+        elif charge < -128: charge = -128
+
         previous_bit = bit
-        
+        out[i] = bit
+
+    bits[:] = np.frombuffer(out, dtype=np.uint8)
+    state[:] = (charge, strength, previous_bit)
+
+def _encode_bits(samples, state, bits):
+    # Prefer the native core (runs without the GIL), then Numba, then Python
+    if _dfpwm is not None:
+        _dfpwm.encode(samples, state, bits)
+    elif HAVE_NUMBA:
+        _encode_dfpwm_core(samples, state, bits)
+    else:
+        _encode_dfpwm_py(samples, state, bits)
+
+# Pay the JIT compile cost once at import rather than on the first song
+if _dfpwm is None and HAVE_NUMBA:
+    _encode_dfpwm_core(np.zeros(8, dtype=np.int8), np.zeros(3, dtype=np.int64),
+                       np.empty(8, dtype=np.uint8))
+
+class DFPWMEncoder:
+    """
+    Streaming DFPWM encoder. Keeps the predictor state and any bits that
+    don't fill a whole byte between feed() calls, so a song can be encoded
+    chunk by chunk with the same output as encoding it in one go.
+    """
+
+    def __init__(self):
+        self.state = np.zeros(3, dtype=np.int64)
+        self.pending = np.zeros(0, dtype=np.uint8)
+
+    def feed(self, pcm_samples):
+        samples = np.ascontiguousarray(pcm_samples, dtype=np.int8)
+
+        # Leftover bits from the previous call go in front of the new ones,
+        # in a buffer allocated once at its final size
+        carry = len(self.pending)
+        bits = np.empty(carry + len(samples), dtype=np.uint8)
+        bits[:carry] = self.pending
+        _encode_bits(samples, self.state, bits[carry:])
+
         # Pack (LSB first convention often used, but CC handles bits effectively as stream)
-        # We'll pack LSB first (1st sample = bit 0)
-        if bit:
-            current_byte |= (1 << bit_idx)
-        
-        bit_idx += 1
-        if bit_idx == 8:
-            out_bytes.append(current_byte)
-            current_byte = 0
-            bit_idx = 0
-            
-    if bit_idx > 0:
-        out_bytes.append(current_byte)
-        
-    return out_bytes
+        # We pack LSB first (1st sample = bit 0); leftover bits wait for the next call
+        whole = len(bits) & ~7
+        self.pending = bits[whole:].copy()
+        return np.packbits(bits[:whole], bitorder='little').tobytes()
+
+    def flush(self):
+        # packbits zero-pads the last partial byte
+        out = np.packbits(self.pending, bitorder='little').tobytes()
+        self.pending = self.pending[:0]
+        return out
+
+def encode_dfpwm(pcm_samples):
+    """
+    Encodes 8-bit signed PCM samples (-128 to 127) into DFPWM.
+    This is an approximation of the standard DFPWM1a algorithm.
+    """
+    samples = np.ascontiguousarray(pcm_samples, dtype=np.int8)
+    bits = np.empty(len(samples), dtype=np.uint8)
+    _encode_bits(samples, np.zeros(3, dtype=np.int64), bits)
+    # Pack LSB first (1st sample = bit 0); packbits zero-pads the last byte
+    return np.packbits(bits, bitorder='little').tobytes()
+
+# Samples each block is pre-rolled with so its guessed starting state has
+# usually converged to the true one by the time its own samples start
+PARALLEL_WARMUP = 256
+# Samples between saved predictor states inside a block (see below)
+PARALLEL_CHECKPOINT = 4096
+
+def encode_dfpwm_parallel(pcm_samples, workers=None):
+    """
+    Encodes like encode_dfpwm, but splits the song into one block per worker
+    and encodes the blocks on threads (the native and Numba cores run without
+    the GIL). Blocks after the first start from a fresh state PARALLEL_WARMUP
+    samples early. Afterwards the true state is carried across each boundary
+    and any checkpoint whose guessed state differs is re-encoded in order
+    until the states agree, so the output is identical to encode_dfpwm.
+    """
+    samples = np.ascontiguousarray(pcm_samples, dtype=np.int8)
+    n = len(samples)
+    workers = workers or os.cpu_count() or 1
+    block = -(-n // workers)
+    if workers <= 1 or block <= PARALLEL_WARMUP:
+        return encode_dfpwm(samples)
+
+    bits = np.empty(n, dtype=np.uint8)
+
+    def encode_block(start):
+        end = min(start + block, n)
+        warm_start = max(0, start - PARALLEL_WARMUP)
+        state = np.zeros(3, dtype=np.int64)
+        _encode_bits(samples[warm_start:start], state,
+                     np.empty(start - warm_start, dtype=np.uint8))
+
+        # Remember the state at each checkpoint for the fix-up pass
+        checkpoints = []
+        for pos in range(start, end, PARALLEL_CHECKPOINT):
+            stop = min(pos + PARALLEL_CHECKPOINT, end)
+            checkpoints.append((pos, stop, state.copy()))
+            _encode_bits(samples[pos:stop], state, bits[pos:stop])
+        return checkpoints, state
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(encode_block, range(0, n, block)))
+
+    state = np.zeros(3, dtype=np.int64)
+    for checkpoints, end_state in results:
+        for pos, stop, guessed in checkpoints:
+            if np.array_equal(state, guessed):
+                # Same state from here on means the same bits to the block end
+                state = end_state
+                break
+            _encode_bits(samples[pos:stop], state, bits[pos:stop])
+
+    # Pack LSB first (1st sample = bit 0); packbits zero-pads the last byte
+    return np.packbits(bits, bitorder='little').tobytes()
 
 def main():
     if len(sys.argv) < 2:
@@ -95,75 +250,87 @@ def main():
     frames = w.readframes(nframes)
     w.close()
     
-    # 2. Convert to Mono 8-bit Signed
-    samples = []
-    
-    # helper: bytes to int
-    def get_sample(idx):
-        if sampwidth == 1:
-            # 8-bit unsigned 0..255 -> -128..127
-            return frames[idx] - 128
-        elif sampwidth == 2:
-            # 16-bit signed -32768..32767 -> -128..127
-            # unpack_from requires a buffer, frames is bytes
-            val = struct.unpack_from('<h', frames, idx)[0]
-            # reduce to 8-bit
-            return val // 256
-        return 0
-
-    step = sampwidth * nchannels
-    for i in range(0, len(frames), step):
-        # Average channels if stereo
-        val = get_sample(i)
-        if nchannels > 1:
-            for ch in range(1, nchannels):
-                val += get_sample(i + ch * sampwidth)
-            val //= nchannels
-        samples.append(val)
+    # 2. View frames as (frames, channels); nothing is converted yet
+    if sampwidth == 1:
+        pcm = np.frombuffer(frames, dtype=np.uint8).reshape(-1, nchannels)
+    elif sampwidth == 2:
+        pcm = np.frombuffer(frames, dtype='<i2').reshape(-1, nchannels)
+    else:
+        print(f"Unsupported sample width: {sampwidth*8}bit (use 8 or 16-bit WAV)")
+        return
+
+    # 3. Convert to Mono 8-bit Signed
+    # Each channel is reduced to 8-bit first, then channels are averaged
+    if sampwidth == 1:
+        # 8-bit unsigned 0..255 -> -128..127
+        pcm = pcm.astype(np.int32) - 128
+    else:
+        # 16-bit signed -32768..32767 -> -128..127
+        pcm = pcm >> 8
+    samples = pcm.sum(axis=1, dtype=np.int32) // nchannels
         
-    # 3. Resample / Downsample
-    # We use simple nearest-neighbor/skip for simplicity
+    # 4. Resample / Downsample
+    # Linear interpolation (avoids the aliasing of nearest-neighbour skipping)
+    # between the two mono samples around each output position
     
     if target_rate != framerate:
         print(f"Resampling from {framerate} to {target_rate}...")
-        ratio = framerate / target_rate
-        new_samples = []
-        idx = 0.0
-        while idx < len(samples):
-            new_samples.append(samples[int(idx)])
-            idx += ratio
-        samples = new_samples
+        last = len(samples) - 1
+        n_out = int(len(samples) * target_rate / framerate)
+        x_new = np.arange(n_out) * (framerate / target_rate)
+        i0 = np.minimum(x_new.astype(np.int64), last)
+        lo = samples[i0]
+        hi = samples[np.minimum(i0 + 1, last)]
+        samples = (hi - lo) * (x_new - i0) + lo
+    samples = samples.astype(np.int8)
     
     print(f"Encoding {len(samples)} samples...")
     
-    # 4. Encode
-    dfpwm_data = encode_dfpwm(samples)
+    # 5. Encode
+    dfpwm_data = encode_dfpwm_parallel(samples)
     
     print(f"Encoded size: {len(dfpwm_data)} bytes")
     
-    # 5. Generate Lua
-    # Use Hex encoding for safety in transport (drag and drop)
-    hex_data = ''.join(f'{b:02X}' for b in dfpwm_data)
+    # 6. Generate Lua
+    # Use Base64 encoding for safety in transport (drag and drop);
+    # it only grows the payload by 4/3 instead of 2x for hex
+    b64_data = base64.b64encode(dfpwm_data).decode('ascii')
     
-    # Chunking
-    chunks = [hex_data[i:i+80] for i in range(0, len(hex_data), 80)]
+    # Chunking (multiple of 4 so every line is a whole Base64 group)
+    chunks = (b64_data[i:i+76] for i in range(0, len(b64_data), 76))
     
     song_name = os.path.splitext(os.path.basename(input_file))[0]
     final_name = song_name + ".dfpwm"
     
-    lua_content = "local h = table.concat({\n"
-    for c in chunks:
-        lua_content += f'"{c}",\n'
-    lua_content += '})\n\n'
-    
-    lua_content += f"""
+    installer = f"""
 print("Installing {final_name}...")
 local f = fs.open("{final_name}", "wb")
 if not f then error("Cannot open file") end
-for i=1, #h, 2 do
-    local b = tonumber(h:sub(i, i+1), 16)
-    f.write(b)
+
+-- Base64 decode via a char lookup table, written out in ~4KB blocks
+local alphabet = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
+local lut = {{}}
+for i = 1, #alphabet do lut[alphabet:byte(i)] = i - 1 end
+local pad = string.byte("=")
+
+local out = {{}}
+for i = 1, #h, 4 do
+    local a, b, c, d = h:byte(i, i + 3)
+    local n = lut[a] * 262144 + lut[b] * 4096 + (lut[c] or 0) * 64 + (lut[d] or 0)
+    local b1, b2, b3 = math.floor(n / 65536), math.floor(n / 256) % 256, n % 256
+    if c == pad then
+        out[#out + 1] = string.char(b1)
+    elseif d == pad then
+        out[#out + 1] = string.char(b1, b2)
+    else
+        out[#out + 1] = string.char(b1, b2, b3)
+    end
+    if #out >= 1365 then
+        f.write(table.concat(out))
+        out = {{}}
+    end
 end
+f.write(table.concat(out))
 f.close()
 print("Saved {final_name} ({len(dfpwm_data)} bytes)")
 
@@ -212,8 +379,13 @@ else
 end
 """
     
+    # Stream the payload lines straight to disk instead of building the
+    # whole Lua source in memory first
     with open(output_file, 'w') as f:
-        f.write(lua_content)
+        f.write("local h = table.concat({\n")
+        f.writelines(f'"{c}",\n' for c in chunks)
+        f.write('})\n\n')
+        f.write(installer)
         
     print(f"Created {output_file}")
     print("1. Drag and drop this file into your ComputerCraft terminal.")
@@ -0,0 +1,16 @@
+# Builds the optional native DFPWM encoder used by encode_song.py:
+#   python setup.py build_ext --inplace
+# Without it the encoder falls back to Numba (or plain Python).
+import sys
+
+from setuptools import setup, Extension
+
+# MSVC optimizes with its own defaults; -O3 is a gcc/clang flag
+extra_compile_args = [] if sys.platform == "win32" else ["-O3", "-funroll-loops"]
+
+setup(
+    name="cc-jukebox-dfpwm",
+    ext_modules=[
+        Extension("_dfpwm", ["_dfpwm.c"], extra_compile_args=extra_compile_args),
+    ],
+)